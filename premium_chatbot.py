@@ -1,101 +1,473 @@
 # premium_chatbot.py
 import os
+import atexit
+import importlib.util
 import json
+import hashlib
+import threading
+import time
+import io
+import wave
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 import streamlit as st
-from datetime import datetime
+from streamlit.errors import StreamlitAPIException
 import re
-import textwrap
-from gtts import gTTS
-import tempfile
 
 # GEMINI / TTS CONFIGURATION
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", None) or st.secrets.get("GEMINI_API_KEY", None) or "YOUR_GEMINI_API_KEY"
 
+GEMINI_MODEL_NAME = "gemini-2.5-flash"
+PIPER_VOICE_MODEL = os.getenv("PIPER_VOICE_MODEL", None)
+TTS_WORKERS = 4
+
+# Cheap availability check; the SDK itself is imported lazily by _get_genai().
 try:
-    import google.generativeai as genai
-    genai.configure(api_key=GEMINI_API_KEY)
-    GEMINI_MODEL_NAME = "gemini-2.5-flash"
-    gemini_available = True
+    gemini_available = (
+        GEMINI_API_KEY != "YOUR_GEMINI_API_KEY"
+        and importlib.util.find_spec("google.generativeai") is not None
+    )
 except Exception:
-    genai = None
     gemini_available = False
 
-MEMORY_FILE = "memory.json"
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import diskcache
+except ImportError:
+    diskcache = None
+
+_CSS = """
+<style>
+/* Your CSS styling here */
+</style>
+"""
+
+_SENT_SPLIT = re.compile(r'(?<=[.!?])\s+')
+
+MEMORY_FILE = "memory.jsonl"
+LEGACY_MEMORY_FILE = "memory.json"  # one JSON list of [role, text, ts, meta] rows
 MAX_MEMORY_MESSAGES = 500
+COMPACT_EVERY = 50
+MAX_RENDER_MESSAGES = 200
+SCROLL_AFTER_MESSAGES = 50
+MAX_CONTEXT_CHARS = 6000
+
+# Escaping and newline conversion in one C-level pass over the text.
+_HTML_TABLE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#x27;', '\n': '<br>'})
+
+def _to_html(text):
+    return text.translate(_HTML_TABLE)
+
+def make_entry(role, text, meta=None, ts=None):
+    return (role, text, ts or timestamp(), meta or {})
+
+def _entry_to_record(entry):
+    role, text, ts, meta = entry
+    return {"role": role, "text": text, "ts": ts, "meta": meta}
+
+def _record_to_entry(record):
+    return make_entry(record["role"], record["text"], record.get("meta"), record["ts"])
+
+def _dump_line(record):
+    if orjson is not None:
+        return orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE)
+    return (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+def _load_line(line):
+    if orjson is not None:
+        return orjson.loads(line)
+    return json.loads(line)
+
+# The session chat is stored column-wise (one bounded deque per field) so
+# render_chat can zip just the columns it needs. The escaped HTML and the
+# "User: ..." prompt line are derived once on append and never persisted.
+_CHAT_COLUMNS = ("roles", "texts", "times", "metas", "html", "lines")
+
+def new_chat():
+    # The session only keeps what can be rendered; older turns stay in MEMORY_FILE.
+    chat = {name: deque(maxlen=MAX_RENDER_MESSAGES) for name in _CHAT_COLUMNS}
+    chat["version"] = 0  # bumped on every change; keys render_chat's HTML cache
+    return chat
+
+def chat_append(chat, entry):
+    role, text, ts, meta = entry
+    chat["roles"].append(role)
+    chat["texts"].append(text)
+    chat["times"].append(ts)
+    chat["metas"].append(meta)
+    chat["html"].append(_to_html(text))
+    chat["lines"].append(("User: " if role == "user" else "Assistant: ") + text)
+    chat["version"] += 1
+
+def chat_clear(chat):
+    for name in _CHAT_COLUMNS:
+        chat[name].clear()
+    chat["version"] += 1
+
+def _import_legacy_memory():
+    # One-time move of the old single-list history into MEMORY_FILE; the old
+    # file is renamed afterwards so it is never imported twice.
+    try:
+        with open(LEGACY_MEMORY_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except Exception:
+        return
+    if not isinstance(data, list):
+        return
+    lines = []
+    for row in data[-MAX_MEMORY_MESSAGES:]:
+        try:
+            role, text, ts, meta = row
+        except (TypeError, ValueError):
+            continue
+        lines.append(_dump_line(_entry_to_record(make_entry(role, text, meta, ts))))
+    try:
+        _replace_lines(lines)
+        os.replace(LEGACY_MEMORY_FILE, LEGACY_MEMORY_FILE + ".bak")
+    except Exception:
+        pass
 
 def load_memory():
-    if os.path.exists(MEMORY_FILE):
+    if not os.path.exists(MEMORY_FILE) and os.path.exists(LEGACY_MEMORY_FILE):
+        _import_legacy_memory()
+    if not os.path.exists(MEMORY_FILE):
+        return new_chat()
+    try:
+        with open(MEMORY_FILE, "rb") as f:
+            lines = [line for line in f if line.strip()]
+    except Exception:
+        return new_chat()
+    if len(lines) > MAX_MEMORY_MESSAGES * 1.5:
+        trim_memory_file()
+    chat = new_chat()
+    for line in lines[-MAX_RENDER_MESSAGES:]:
         try:
-            with open(MEMORY_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                if isinstance(data, list):
-                    return data
+            chat_append(chat, _record_to_entry(_load_line(line)))
         except Exception:
-            return []
-    return []
-
-def save_memory(mem):
-    try:
-        with open(MEMORY_FILE, "w", encoding="utf-8") as f:
-            json.dump(mem[-MAX_MEMORY_MESSAGES:], f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        st.error("Could not save memory: " + str(e))
+            continue
+    return chat
+
+# Memory writes go through one background worker so Send never waits on disk.
+# A single thread keeps appends, trims and clears in submission order.
+@st.cache_resource(show_spinner=False)
+def _memory_executor():
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory")
+    # atexit runs handlers in reverse: flush queued writes, then compact.
+    atexit.register(_trim_lines)
+    atexit.register(executor.shutdown, wait=True)
+    return executor
+
+def _write_async(fn, *args):
+    future = _memory_executor().submit(fn, *args)
+    st.session_state.setdefault("memory_writes", []).append(future)
+
+def report_memory_errors():
+    writes = st.session_state.get("memory_writes")
+    if not writes:
+        return
+    pending = []
+    for future in writes:
+        if not future.done():
+            pending.append(future)
+        elif future.exception() is not None:
+            st.error("Could not save memory: " + str(future.exception()))
+    st.session_state.memory_writes = pending
+
+def _append_lines(data):
+    with open(MEMORY_FILE, "ab") as f:
+        f.write(data)
+
+def _replace_lines(lines):
+    # Write a temp file and swap it in, so load_memory in another session never
+    # sees a half-written file and a crash leaves the old one intact.
+    tmp = MEMORY_FILE + ".tmp"
+    with open(tmp, "wb") as f:
+        f.writelines(lines)
+    os.replace(tmp, MEMORY_FILE)
+
+def _trim_lines():
+    if not os.path.exists(MEMORY_FILE):
+        return
+    with open(MEMORY_FILE, "rb") as f:
+        lines = f.readlines()
+    if len(lines) <= MAX_MEMORY_MESSAGES:
+        return
+    _replace_lines(lines[-MAX_MEMORY_MESSAGES:])
+
+def _truncate():
+    open(MEMORY_FILE, "wb").close()
+
+def append_messages(entries):
+    if not entries:
+        return
+    _write_async(_append_lines, b"".join(_dump_line(_entry_to_record(entry)) for entry in entries))
+    appended = st.session_state.get("memory_appends", 0) + len(entries)
+    if appended >= COMPACT_EVERY:
+        trim_memory_file()
+        appended = 0
+    st.session_state.memory_appends = appended
+
+def trim_memory_file():
+    _write_async(_trim_lines)
+
+def clear_memory():
+    _write_async(_truncate)
 
 def smart_trim_text(text, max_sentences=3):
-    sentences = re.split(r'(?<=[.!?])\s+', text.strip())
-    if len(sentences) <= max_sentences:
+    # Fewer terminators than max_sentences means there is nothing to trim.
+    if text.count('.') + text.count('!') + text.count('?') < max_sentences:
         return text, None
-    short = " ".join(sentences[:max_sentences])
-    remainder = " ".join(sentences[max_sentences:])
-    return short + " ...", remainder
+    # Stop at the Nth sentence boundary; the compiled pattern does the scanning
+    # in C and nothing past the cut point is split or joined.
+    body = text.strip()
+    for count, m in enumerate(_SENT_SPLIT.finditer(body), 1):
+        if count == max_sentences:
+            return body[:m.start()] + " ...", body[m.end():]
+    return text, None
+
+_FALLBACK_RE = re.compile(r'\b(time|date|joke)\b')
+
+_OFFLINE_GREETING = "Hi — I'm offline right now, but I can still answer a few simple questions. Try asking 'time' or 'date'."
+# Checked in this order when several topics appear in one message.
+_OFFLINE_REPLIES = {
+    "time": lambda: "I can't fetch external data offline, but your system time is available locally.",
+    "date": lambda: time.strftime("%A, %B %d, %Y"),
+    "joke": lambda: "Why did the programmer quit his job? Because he didn't get arrays (a raise).",
+}
+_OFFLINE_DEFAULT = "Sorry — I can't reach Gemini now. Try again later or enable offline-friendly prompts."
 
 def offline_fallback(prompt):
     p = prompt.strip().lower()
+    # A greeting only wins when it is the whole message, so "hi, what's the
+    # date?" still gets the date.
     if p in ("hi", "hello", "hey"):
-        return "Hi — I'm offline right now, but I can still answer a few simple questions. Try asking 'time' or 'date'."
-    if "time" in p:
-        return "I can't fetch external data offline, but your system time is available locally."
-    if "date" in p:
-        return datetime.now().strftime("%A, %B %d, %Y")
-    if "joke" in p:
-        return "Why did the programmer quit his job? Because he didn't get arrays (a raise)."
-    return "Sorry — I can't reach Gemini now. Try again later or enable offline-friendly prompts."
-
-def generate_gemini_answer(prompt, system_instruction=None):
-    if not gemini_available or genai is None:
-        return offline_fallback(prompt)
+        return _OFFLINE_GREETING
+    # One scan over the message; whole words only, so "datetime" is not "time".
+    found = set(_FALLBACK_RE.findall(p))
+    for topic, reply in _OFFLINE_REPLIES.items():
+        if topic in found:
+            return reply()
+    return _OFFLINE_DEFAULT
+
+GEMINI_CACHE_TTL = 3600
+GEMINI_CACHE_ENTRIES = 256
+ANSWER_CACHE_DIR = ".answer_cache"
+
+@st.cache_resource(show_spinner=False)
+def _get_genai(api_key):
+    import google.generativeai as genai
+    genai.configure(api_key=api_key)
+    return genai
+
+# One model object per (model, system instruction), i.e. per mood/name combo.
+@st.cache_resource(show_spinner=False, max_entries=32)
+def _get_model(model_name, system_instruction=None):
+    return _get_genai(GEMINI_API_KEY).GenerativeModel(model_name, system_instruction=system_instruction)
+
+# Process-wide answer cache shared by every session. Identical prompts (same
+# history, mood and name) are replayed from here instead of hitting Gemini.
+@st.cache_resource(show_spinner=False)
+def _answer_cache():
+    return threading.Lock(), OrderedDict()
+
+# With diskcache installed, answers also survive restarts. Entries are keyed
+# by a digest of the full cache key and expire after the same TTL.
+@st.cache_resource(show_spinner=False)
+def _disk_answer_cache():
+    if diskcache is None:
+        return None
+    try:
+        return diskcache.Cache(ANSWER_CACHE_DIR)
+    except Exception:
+        return None
+
+def _disk_key(key):
+    return hashlib.blake2b(json.dumps(key).encode("utf-8"), digest_size=16).hexdigest()
+
+def _cached_answer(key):
+    lock, store = _answer_cache()
+    with lock:
+        hit = store.get(key)
+        if hit is not None:
+            saved_at, text = hit
+            if time.time() - saved_at <= GEMINI_CACHE_TTL:
+                store.move_to_end(key)
+                return text
+            del store[key]
+    disk = _disk_answer_cache()
+    if disk is None:
+        return None
+    try:
+        hit = disk.get(_disk_key(key))
+    except Exception:
+        return None
+    if not isinstance(hit, tuple):
+        return None
+    # Promote with the original save time so the TTL still counts from there.
+    saved_at, text = hit
+    _remember_answer(key, text, saved_at)
+    return text
+
+def _remember_answer(key, text, saved_at=None):
+    lock, store = _answer_cache()
+    with lock:
+        store[key] = (saved_at or time.time(), text)
+        store.move_to_end(key)
+        while len(store) > GEMINI_CACHE_ENTRIES:
+            store.popitem(last=False)
+
+def _store_answer(key, text):
+    saved_at = time.time()
+    _remember_answer(key, text, saved_at)
+    disk = _disk_answer_cache()
+    if disk is not None:
+        try:
+            disk.set(_disk_key(key), (saved_at, text), expire=GEMINI_CACHE_TTL)
+        except Exception:
+            pass
+
+def stream_gemini_answer(prompt, user_msg=None, system_instruction=None):
+    # user_msg is what the offline fallback matches on; the full prompt also
+    # carries the system text and history, which would trigger false hits.
+    if not gemini_available:
+        yield offline_fallback(user_msg or prompt)
+        return
+    key = (prompt, system_instruction, GEMINI_MODEL_NAME)
+    cached = _cached_answer(key)
+    if cached is not None:
+        yield cached
+        return
+    parts = []
     try:
-        contents = []
-        if system_instruction:
-            contents.append({"role": "system", "content": system_instruction})
-        contents.append({"role": "user", "content": prompt})
-        model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+        model = _get_model(GEMINI_MODEL_NAME, system_instruction)
         # IMPORTANT: Removed max_output_tokens here
-        resp = model.generate_content(prompt)
-        if hasattr(resp, "text") and resp.text:
-            return resp.text
-        if hasattr(resp, "output") and resp.output:
+        for chunk in model.generate_content(prompt, stream=True):
             try:
-                return resp.output[0].content[0].text
-            except Exception:
-                return str(resp)
-        return str(resp)
+                text = chunk.text
+            except (AttributeError, ValueError):
+                # The SDK raises ValueError for chunks with no text parts
+                # (e.g. a safety stop); skip those instead of aborting.
+                text = ""
+            if text:
+                parts.append(text)
+                yield text
+    except Exception as e:
+        yield f"\n\n⚠️ Gemini error: {e}. (Falling back offline.)\n\n" + offline_fallback(user_msg or prompt)
+        return
+    if not parts:
+        # Every chunk was empty, e.g. the whole reply was blocked.
+        yield "⚠️ Gemini returned no text (the reply may have been blocked). (Falling back offline.)\n\n" + offline_fallback(user_msg or prompt)
+        return
+    _store_answer(key, "".join(parts))
+
+# gTTS is a network round-trip, so synthesis runs on a background pool that
+# outlives reruns; the audio is picked up by the next run of the script.
+@st.cache_resource(show_spinner=False)
+def _tts_executor():
+    return ThreadPoolExecutor(max_workers=TTS_WORKERS, thread_name_prefix="tts")
+
+def _piper_pcm(voice, text):
+    # Raw 16-bit mono PCM; play_pending_audio wraps the frames in a WAV header.
+    return b"".join(chunk.audio_int16_bytes for chunk in voice.synthesize(text))
+
+# The TTS backend is only imported once someone actually enables voice output,
+# and then only once per process. A local Piper voice (PIPER_VOICE_MODEL)
+# avoids gTTS's network round-trip; gTTS remains the fallback.
+@st.cache_resource(show_spinner=False)
+def get_tts_engine():
+    if PIPER_VOICE_MODEL:
+        try:
+            from piper import PiperVoice
+            voice = PiperVoice.load(PIPER_VOICE_MODEL)
+            # A test phrase, so an incompatible piper-tts falls back to gTTS
+            # here instead of failing on every sentence.
+            _piper_pcm(voice, "Ready.")
+            return "piper", voice
+        except Exception:
+            pass
+    from gtts import gTTS
+    return "gtts", gTTS
+
+# Repeated phrases (welcome, /help, canned replies) are synthesized once. The
+# engine is process-wide, so it is left out of the cache key.
+@st.cache_data(max_entries=256, show_spinner=False)
+def _synthesize(_engine, text):
+    kind, impl = _engine
+    if kind == "piper":
+        return _piper_pcm(impl, text)
+    tts = impl(text=text, lang='en', slow=False)
+    buf = io.BytesIO()
+    tts.write_to_fp(buf)
+    return buf.getvalue()
+
+def _queue_speech(sentences):
+    # One job per sentence, synthesized in parallel. The futures are kept in
+    # submission order, so the segments still join into one clip in order.
+    try:
+        engine = get_tts_engine()
     except Exception as e:
-        return f"⚠️ Gemini error: {e}. (Falling back offline.)\n\n" + offline_fallback(prompt)
+        st.warning("TTS failed: " + str(e))
+        return
+    executor = _tts_executor()
+    pending = st.session_state.setdefault("pending_audio", [])
+    for sentence in sentences:
+        if sentence:
+            pending.append(executor.submit(_synthesize, engine, sentence))
 
 def speak(text):
+    _queue_speech(_SENT_SPLIT.split(text.strip()))
+
+def speak_stream(chunks, max_sentences=None):
+    # Passes the chunks through while handing every completed sentence to the
+    # TTS worker, so synthesis overlaps with the rest of the Gemini stream.
+    tail = ""
+    spoken = 0
+    for chunk in chunks:
+        if max_sentences is None or spoken < max_sentences:
+            sentences = _SENT_SPLIT.split((tail + chunk).lstrip())
+            tail = sentences.pop()
+            if max_sentences is not None:
+                sentences = sentences[:max_sentences - spoken]
+            if sentences:
+                _queue_speech(sentences)
+                spoken += len(sentences)
+        yield chunk
+    if tail.strip() and (max_sentences is None or spoken < max_sentences):
+        _queue_speech([tail])
+
+def play_pending_audio():
+    pending = st.session_state.pop("pending_audio", None)
+    if not pending:
+        return
     try:
-        tts = gTTS(text=text, lang='en', slow=False)
-        with tempfile.NamedTemporaryFile(delete=True, suffix=".mp3") as fp:
-            tts.save(fp.name)
-            fp.seek(0)
-            audio_bytes = fp.read()
+        kind, impl = get_tts_engine()
+        audio_bytes = b"".join(future.result() for future in pending)
+        if kind == "piper":
+            buf = io.BytesIO()
+            with wave.open(buf, "wb") as wav:
+                wav.setnchannels(1)
+                wav.setsampwidth(2)
+                wav.setframerate(impl.config.sample_rate)
+                wav.writeframes(audio_bytes)
+            st.audio(buf.getvalue(), format="audio/wav")
+        else:
             st.audio(audio_bytes, format="audio/mp3")
     except Exception as e:
         st.warning("TTS failed: " + str(e))
 
 def timestamp():
-    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    # Stored as epoch seconds; formatted only for the bubbles actually shown.
+    return time.time()
+
+def format_timestamp(ts):
+    if isinstance(ts, str):  # rows imported from memory.json keep their strings
+        return ts
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts))
 
 # Initialize session state keys safely
 if "chat" not in st.session_state:
@@ -115,11 +487,7 @@ if "trim_long_reads" not in st.session_state:
 
 st.set_page_config(page_title="✨ Premium Text+Voice ChatBot", page_icon="🤖", layout="wide")
 
-st.markdown("""
-<style>
-/* Your CSS styling here */
-</style>
-""", unsafe_allow_html=True)
+st.markdown(_CSS, unsafe_allow_html=True)
 
 st.markdown("<div class='chat-area'>", unsafe_allow_html=True)
 st.markdown("<div class='header'><h1 style='margin:0'>🤖 Premium Text + Voice ChatBot</h1><div class='subtle'>Gemini-backed answers • Voice • Personalities • Memory</div></div>", unsafe_allow_html=True)
@@ -153,7 +521,7 @@ with st.sidebar:
     st.markdown("---")
     st.write("Commands: `/help`, `/clear`, `/time`, `/date`, `/about`")
     if st.button("Clear persistent memory (all)"):
-        save_memory([])
+        clear_memory()
         st.success("Memory cleared.")
     st.markdown(f"Gemini available: **{'Yes' if gemini_available else 'No'}**")
     if not gemini_available:
@@ -162,123 +530,189 @@ with st.sidebar:
 def format_role(role):
     return "You" if role == "user" else "Assistant"
 
-def render_chat():
-    for role, text, time_str, meta in st.session_state.chat[-200:]:
-        safe_text = text.replace("\n","<br>")
+def _chat_html(chat, user_name):
+    count = len(chat["roles"])
+    start = max(0, count - MAX_RENDER_MESSAGES)
+    parts = []
+    rows = zip(islice(chat["roles"], start, None), islice(chat["times"], start, None), islice(chat["html"], start, None))
+    for role, ts, safe_text in rows:
+        time_str = format_timestamp(ts)
         if role == "user":
-            st.markdown(f"<div class='bubble user'><b>🧑 {st.session_state.username or 'You'}:</b><br>{safe_text}</div><div class='meta' style='text-align:right'>{time_str}</div>", unsafe_allow_html=True)
+            parts.append(f"<div class='bubble user'><b>🧑 {user_name}:</b><br>{safe_text}</div><div class='meta' style='text-align:right'>{time_str}</div>")
         else:
-            st.markdown(f"<div class='bubble bot'><b>🤖 Bot:</b><br>{safe_text}</div><div class='meta'>{time_str}</div>", unsafe_allow_html=True)
+            parts.append(f"<div class='bubble bot'><b>🤖 Bot:</b><br>{safe_text}</div><div class='meta'>{time_str}</div>")
+    body = "".join(parts)
+    if count - start > SCROLL_AFTER_MESSAGES:
+        body = f"<div class='chat-scroll' style='max-height:70vh;overflow-y:auto'>{body}</div>"
+    return body
 
-if not st.session_state.chat:
+def render_chat():
+    # Streamlit drops anything not re-emitted on a rerun, so the markdown is
+    # always sent, but the HTML is only rebuilt when the chat or name changed.
+    chat = st.session_state.chat
+    user_name = _to_html(st.session_state.username or 'You')
+    key = (chat["version"], user_name)
+    cached = st.session_state.get("_render_cache")
+    if cached is None or cached[0] != key:
+        cached = (key, _chat_html(chat, user_name))
+        st.session_state._render_cache = cached
+    # One st.markdown for the whole history instead of one per bubble.
+    st.markdown(cached[1], unsafe_allow_html=True)
+
+if not st.session_state.chat["roles"]:
     welcome = "Hello! I'm your premium assistant. Ask me anything — choose a personality from the sidebar. Try `/help` to see commands."
-    st.session_state.chat = [("bot", welcome, timestamp(), {})]
-
-render_chat()
-
-col_input, col_send = st.columns([8,1])
-with col_input:
-    user_input = st.text_input("💬 Type your message (or use a command)", key="main_input", value="")
-with col_send:
-    send = st.button("Send")
+    welcome_entry = make_entry("bot", welcome)
+    chat_append(st.session_state.chat, welcome_entry)
+    append_messages([welcome_entry])
+
+HELP_TEXT = """
+**Pro Commands**
+- /help — show this help
+- /clear — clear conversation (session)
+- /time — current time
+- /date — current date
+- /about — about this bot
+"""
+
+ABOUT_TEXT = "✨ Premium Text+Voice ChatBot — Gemini-powered (optional). Features: personalities, smart read, persistent memory."
+
+def _cmd_help():
+    return make_entry("bot", HELP_TEXT)
+
+def _cmd_clear():
+    chat_clear(st.session_state.chat)
+    clear_memory()
+    return make_entry("bot", "Conversation cleared (session).")
+
+def _cmd_time():
+    return make_entry("bot", "🕒 Current time: " + time.strftime("%H:%M:%S"))
+
+def _cmd_date():
+    return make_entry("bot", "📅 " + time.strftime("%A, %B %d, %Y"))
+
+def _cmd_about():
+    return make_entry("bot", ABOUT_TEXT)
+
+_COMMANDS = {
+    "/help": _cmd_help,
+    "/clear": _cmd_clear,
+    "/time": _cmd_time,
+    "/date": _cmd_date,
+    "/about": _cmd_about,
+}
 
 def handle_command(cmd):
-    cmd = cmd.strip().lower()
-    if cmd == "/help":
-        return ("bot", textwrap.dedent("""
-            **Pro Commands**
-            - /help — show this help
-            - /clear — clear conversation (session)
-            - /time — current time
-            - /date — current date
-            - /about — about this bot
-            """), timestamp(), {})
-    if cmd == "/clear":
-        st.session_state.chat = []
-        return ("bot", "Conversation cleared (session).", timestamp(), {})
-    if cmd == "/time":
-        return ("bot", "🕒 Current time: " + datetime.now().strftime("%H:%M:%S"), timestamp(), {})
-    if cmd == "/date":
-        return ("bot", "📅 " + datetime.now().strftime("%A, %B %d, %Y"), timestamp(), {})
-    if cmd == "/about":
-        about = "✨ Premium Text+Voice ChatBot — Gemini-powered (optional). Features: personalities, smart read, persistent memory."
-        return ("bot", about, timestamp(), {})
-    return None
-
-def system_prompt_for_mood(mood):
-    base = "You are a helpful assistant."
-    if mood == "Formal":
-        return base + " Answer politely, concisely, and formally."
-    if mood == "Playful":
-        return base + " Be playful, use light humor and friendly tone."
-    if mood == "Sarcastic":
-        return base + " Use mild sarcasm and witty lines while staying helpful."
-    if mood == "Teacher":
-        return base + " Explain clearly with examples and simple language."
-    return base + " Be friendly, clear, and encouraging."
-
-def build_context_prompt(user_msg, memory_window=8):
-    recent = st.session_state.chat[-(memory_window*1 + 1):]
-    convo = []
-    for role, text, t, meta in recent:
-        role_label = "User" if role == "user" else "Assistant"
-        convo.append(f"{role_label}: {text}")
+    handler = _COMMANDS.get(cmd.strip().lower())
+    return handler() if handler else None
+
+_MOOD_PROMPTS = {
+    "Friendly": "You are a helpful assistant. Be friendly, clear, and encouraging.",
+    "Formal": "You are a helpful assistant. Answer politely, concisely, and formally.",
+    "Playful": "You are a helpful assistant. Be playful, use light humor and friendly tone.",
+    "Sarcastic": "You are a helpful assistant. Use mild sarcasm and witty lines while staying helpful.",
+    "Teacher": "You are a helpful assistant. Explain clearly with examples and simple language.",
+}
+
+def system_prompt_for_mood(mood, username=""):
+    system_inst = _MOOD_PROMPTS.get(mood, _MOOD_PROMPTS["Friendly"])
+    if username:
+        system_inst += f" Address the user as {username} when appropriate."
+    return system_inst
+
+def build_context_prompt(user_msg, max_chars=MAX_CONTEXT_CHARS):
+    # Walk back from the newest message and keep whole turns until the budget
+    # is spent, so one long answer can't bloat every later prompt.
+    convo = deque()
+    used = 0
+    for line in reversed(st.session_state.chat["lines"]):
+        used += len(line) + 1
+        if used > max_chars:
+            break
+        convo.appendleft(line)
     convo_text = "\n".join(convo)
-    system_inst = system_prompt_for_mood(st.session_state.mood)
-    if st.session_state.username:
-        system_inst += f" Address the user as {st.session_state.username} when appropriate."
-    prompt = f"{system_inst}\nConversation:\n{convo_text}\nUser: {user_msg}\nAssistant:"
+    prompt = f"Conversation:\n{convo_text}\nUser: {user_msg}\nAssistant:"
     return prompt
 
-if send and user_input:
-    msg = user_input.strip()
-    if not msg:
-        st.warning("Type a message first.")
-    else:
-        st.session_state.chat.append(("user", msg, timestamp(), {}))
-        if msg.startswith("/"):
-            cmd_result = handle_command(msg)
-            if cmd_result:
-                st.session_state.chat.append(cmd_result)
-                save_memory(st.session_state.chat)
-                st.session_state.main_input = ""
-                st.experimental_rerun()
+def build_system_instruction():
+    return system_prompt_for_mood(st.session_state.mood, st.session_state.username)
+
+# Chat widgets live in a fragment so submitting a message or pressing
+# "Continue reading" reruns only this part, not the sidebar and page setup.
+@st.fragment
+def chat_fragment():
+    report_memory_errors()
+    render_chat()
+
+    # st.chat_input only reruns on submit and clears itself afterwards.
+    user_input = st.chat_input("💬 Type your message (or use a command)", key="main_input")
+
+    needs_rerun = False
+    if user_input:
+        msg = user_input.strip()
+        if not msg:
+            st.warning("Type a message first.")
+        else:
+            user_entry = make_entry("user", msg)
+            chat_append(st.session_state.chat, user_entry)
+            new_entries = [user_entry]
+            if msg.startswith("/"):
+                cmd_result = handle_command(msg) or make_entry("bot", "Unknown command. Try /help.")
+                if not st.session_state.chat["roles"]:
+                    # /clear wiped the session and the memory file, including this command.
+                    new_entries = []
+                chat_append(st.session_state.chat, cmd_result)
+                new_entries.append(cmd_result)
             else:
-                st.session_state.chat.append(("bot", "Unknown command. Try /help.", timestamp(), {}))
-                save_memory(st.session_state.chat)
-                st.session_state.main_input = ""
-                st.experimental_rerun()
-
-        prompt = build_context_prompt(msg, memory_window=6)
-
-        with st.spinner("Thinking..."):
-            raw_answer = generate_gemini_answer(prompt)
-
-        displayed, remainder = raw_answer, None
-        if st.session_state.trim_long_reads:
-            displayed, remainder = smart_trim_text(raw_answer, max_sentences=3)
-
-        meta = {"full": raw_answer, "remainder": remainder}
-        st.session_state.chat.append(("bot", displayed, timestamp(), meta))
-        st.session_state.last_response = raw_answer
-
-        if st.session_state.voice_on:
-            speak(displayed)
-
-        save_memory(st.session_state.chat)
-        st.session_state.main_input = ""
-        st.experimental_rerun()
-
-if st.session_state.chat:
-    last_role, last_text, last_time, last_meta = st.session_state.chat[-1]
-    if last_role == "bot" and last_meta and last_meta.get("remainder"):
-        if st.button("Continue reading"):
-            remainder_text = last_meta["remainder"]
-            st.session_state.chat.append(("bot", remainder_text, timestamp(), {"full": last_meta["full"], "remainder": None}))
-            if st.session_state.voice_on:
-                speak(remainder_text)
-            save_memory(st.session_state.chat)
-            st.experimental_rerun()
+                prompt = build_context_prompt(msg)
+
+                placeholder = st.empty()
+                placeholder.markdown("_Thinking..._")
+                chunks = stream_gemini_answer(prompt, msg, build_system_instruction())
+                if st.session_state.voice_on:
+                    chunks = speak_stream(chunks, 3 if st.session_state.trim_long_reads else None)
+                buf = []
+                for chunk in chunks:
+                    buf.append(chunk)
+                    placeholder.markdown("".join(buf))
+                raw_answer = "".join(buf).strip()
+
+                displayed, remainder = raw_answer, None
+                if st.session_state.trim_long_reads:
+                    displayed, remainder = smart_trim_text(raw_answer, max_sentences=3)
+
+                meta = {"remainder": remainder}
+                bot_entry = make_entry("bot", displayed, meta)
+                chat_append(st.session_state.chat, bot_entry)
+                new_entries.append(bot_entry)
+
+            append_messages(new_entries)
+            needs_rerun = True
+
+    if st.session_state.chat["roles"]:
+        last_role, last_meta = st.session_state.chat["roles"][-1], st.session_state.chat["metas"][-1]
+        if last_role == "bot" and last_meta and last_meta.get("remainder"):
+            if st.button("Continue reading"):
+                remainder_text = last_meta["remainder"]
+                continued_entry = make_entry("bot", remainder_text, {"remainder": None})
+                chat_append(st.session_state.chat, continued_entry)
+                append_messages([continued_entry])
+                if st.session_state.voice_on:
+                    speak(remainder_text)
+                needs_rerun = True
+
+    if needs_rerun:
+        try:
+            # Only the chat changed, so repaint just this fragment.
+            st.rerun(scope="fragment")
+        except StreamlitAPIException:
+            # Streamlit refuses fragment-scoped reruns during a full-app run.
+            st.rerun()
+
+    # Last, because joining the queued synthesis can block; the input and the
+    # Continue reading button are already on screen by then.
+    play_pending_audio()
+
+chat_fragment()
 
 st.markdown("</div>", unsafe_allow_html=True)
 st.markdown("<div style='text-align:center;color:#9aa4b2;font-size:12px;margin-top:10px'>Made with ❤️ by Kaif Ansari — Gemini-powered (optional)</div>", unsafe_allow_html=True)